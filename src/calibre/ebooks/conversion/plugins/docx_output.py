@@ -76,10 +76,11 @@ class DOCXOutput(OutputFormatPlugin):
         from lxml import etree
         from calibre.ebooks.oeb.base import OPF, OPF2_NS
         from calibre.ebooks.metadata.opf2 import OPF as ReadOPF
-        from io import BytesIO
         package = etree.Element(OPF('package'), attrib={'version': '2.0'}, nsmap={None: OPF2_NS})
         oeb.metadata.to_opf2(package)
-        self.mi = ReadOPF(BytesIO(etree.tostring(package, encoding='utf-8')), populate_spine=False, try_to_guess_cover=False).to_book_metadata()
+        # Read the metadata from the tree directly, instead of serializing
+        # and re-parsing it
+        self.mi = ReadOPF(None, preparsed_opf=package, populate_spine=False, try_to_guess_cover=False, read_toc=False).to_book_metadata()
 
     def convert(self, oeb, output_path, input_plugin, opts, log):
         from calibre.ebooks.docx.writer.container import DOCX
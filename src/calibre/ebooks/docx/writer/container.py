@@ -5,30 +5,131 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 __license__ = 'GPL v3'
 __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 
-import textwrap, os
+import io, os, time, zlib
+from multiprocessing.pool import ThreadPool
+from xml.sax.saxutils import escape
 
 from lxml import etree
 from lxml.builder import ElementMaker
 
-from calibre import guess_type
+from calibre import guess_type, detect_ncpus as cpu_count
 from calibre.constants import numeric_version, __appname__
-from calibre.ebooks.docx.names import DOCXNamespace
+from calibre.ebooks.docx.names import DOCXNamespace, TRANSITIONAL_NAMES, TRANSITIONAL_NAMESPACES
 from calibre.ebooks.metadata import authors_to_string
 from calibre.ebooks.pdf.render.common import PAPER_SIZES
+from calibre.utils.cleantext import clean_xml_chars
 from calibre.utils.date import utcnow
 from calibre.utils.localization import canonicalize_lang, lang_as_iso639_1
-from calibre.utils.zipfile import ZipFile
-from polyglot.builtins import iteritems, map, unicode_type, native_string_type
+from calibre.utils.zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
+from polyglot.builtins import iteritems, map, range, unicode_type
+from polyglot.functools import lru_cache
 
+_EXTSEP = os.extsep
 
-def xml2str(root, pretty_print=False, with_tail=False):
-    if hasattr(etree, 'cleanup_namespaces'):
+
+def xml2str(root, pretty_print=False, with_tail=False, skip_cleanup=False):
+    if not skip_cleanup and hasattr(etree, 'cleanup_namespaces'):
         etree.cleanup_namespaces(root)
     ans = etree.tostring(root, encoding='utf-8', xml_declaration=True,
                           pretty_print=pretty_print, with_tail=with_tail)
     return ans
 
 
+_NSMAP_W = {'w': TRANSITIONAL_NAMESPACES['w']}
+_NSMAP_WR = {k: TRANSITIONAL_NAMESPACES[k] for k in 'wr'}
+_W_FONTS = '{%s}fonts' % TRANSITIONAL_NAMESPACES['w']
+_W_NUMBERING = '{%s}numbering' % TRANSITIONAL_NAMESPACES['w']
+_NSMAP_PR = {None: TRANSITIONAL_NAMESPACES['pr']}
+_PR_RELATIONSHIPS = '{%s}Relationships' % TRANSITIONAL_NAMESPACES['pr']
+
+
+# Whitespace other than space has to be escaped in attribute values, as
+# parsers normalize it to spaces otherwise, the same as lxml does
+_XML_ENTITIES = {'"': '&quot;', '\t': '&#9;', '\n': '&#10;', '\r': '&#13;'}
+
+
+@lru_cache(maxsize=512)
+def _xml_escape(raw):
+    # Relationship types, MIME types and most targets come from a small
+    # vocabulary, so the same strings are escaped over and over. Characters
+    # not allowed in XML are removed, as they would make the output invalid.
+    return escape(clean_xml_chars(raw), _XML_ENTITIES).encode('utf-8')
+
+
+# Boilerplate {{{
+# These documents have a fixed structure, so they are generated directly as
+# bytes, without building and serializing an lxml tree for every write.
+_XML_DECLARATION = b"<?xml version='1.0' encoding='utf-8'?>\n"
+
+_CONTAINER_RELS = '''\
+<?xml version='1.0' encoding='utf-8'?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+    <Relationship Id="rId3" Type="{APPPROPS}" Target="docProps/app.xml"/>
+    <Relationship Id="rId2" Type="{DOCPROPS}" Target="docProps/core.xml"/>
+    <Relationship Id="rId1" Type="{DOCUMENT}" Target="word/document.xml"/>
+</Relationships>'''.format(**TRANSITIONAL_NAMES).encode('utf-8')
+
+_WEB_SETTINGS = _XML_DECLARATION + (
+    '<w:webSettings xmlns:w="{}"><w:optimizeForBrowser/><w:allowPNG/><w:doNotSaveAsSingleFile/></w:webSettings>'.format(
+        TRANSITIONAL_NAMESPACES['w'])).encode('utf-8')
+
+_AP_PREFIX = _XML_DECLARATION + (
+    '<Properties xmlns="{}"><Application>{}</Application><AppVersion>{:02d}.{:04d}</AppVersion>'
+    '<DocSecurity>0</DocSecurity><HyperlinksChanged>false</HyperlinksChanged><LinksUpToDate>true</LinksUpToDate>'
+    '<ScaleCrop>false</ScaleCrop><SharedDoc>false</SharedDoc>').format(
+        TRANSITIONAL_NAMESPACES['ep'], __appname__, *numeric_version[:2]).encode('utf-8')
+_AP_SUFFIX = b'</Properties>'
+
+_CT_OVERRIDES = (
+    ("/word/footnotes.xml", "application/vnd.openxmlformats-officedocument.wordprocessingml.footnotes+xml"),
+    ("/word/document.xml", "application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"),
+    ("/word/numbering.xml", "application/vnd.openxmlformats-officedocument.wordprocessingml.numbering+xml"),
+    ("/word/styles.xml", "application/vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"),
+    ("/word/endnotes.xml", "application/vnd.openxmlformats-officedocument.wordprocessingml.endnotes+xml"),
+    ("/word/settings.xml", "application/vnd.openxmlformats-officedocument.wordprocessingml.settings+xml"),
+    ("/word/theme/theme1.xml", "application/vnd.openxmlformats-officedocument.theme+xml"),
+    ("/word/fontTable.xml", "application/vnd.openxmlformats-officedocument.wordprocessingml.fontTable+xml"),
+    ("/word/webSettings.xml", "application/vnd.openxmlformats-officedocument.wordprocessingml.webSettings+xml"),
+    ("/docProps/core.xml", "application/vnd.openxmlformats-package.core-properties+xml"),
+    ("/docProps/app.xml", "application/vnd.openxmlformats-officedocument.extended-properties+xml"),
+)
+_CT_EXT_DEFAULTS = (
+    ("rels", "application/vnd.openxmlformats-package.relationships+xml"),
+    ("odttf", "application/vnd.openxmlformats-officedocument.obfuscatedFont"),
+)
+_CT_IMAGE_EXTS = ('png', 'gif', 'jpeg', 'jpg', 'svg', 'xml')
+_CT_BUILTIN_EXTS = frozenset(_CT_IMAGE_EXTS + tuple(ext for ext, mt in _CT_EXT_DEFAULTS))
+_CT_FIXED_PREFIX = _XML_DECLARATION + (
+    '<Types xmlns="{}">'.format(TRANSITIONAL_NAMESPACES['ct']) +
+    ''.join('<Override PartName="%s" ContentType="%s"/>' % x for x in _CT_OVERRIDES) +
+    ''.join('<Default Extension="%s" ContentType="%s"/>' % x for x in _CT_EXT_DEFAULTS)
+).encode('utf-8')
+_CT_SUFFIX = b'</Types>'
+
+
+@lru_cache(maxsize=64)
+def _mt_for_ext(ext):
+    return guess_type('a.' + ext)[0]
+
+
+def _ct_default(ext, mt):
+    return b'<Default Extension="%s" ContentType="%s"/>' % (_xml_escape(ext), _xml_escape(mt))
+
+
+@lru_cache(maxsize=1)
+def _ct_prefix():
+    # The MIME types of the builtin image extensions are only looked up on
+    # first use, as guess_type() has to load the mimetypes database
+    return _CT_FIXED_PREFIX + b''.join(_ct_default(ext, _mt_for_ext(ext)) for ext in _CT_IMAGE_EXTS)
+
+
+_RELS_PREFIX = b'<Relationships xmlns="%s">'
+_REL_ENTRY = b'<Relationship Id="%s" Type="%s" Target="%s"'
+_REL_TARGET_MODE = b' TargetMode="%s"'
+_RELS_SUFFIX = b'</Relationships>'
+# }}}
+
+
 def page_size(opts):
     width, height = PAPER_SIZES[opts.docx_page_size]
     if opts.docx_custom_page_size is not None:
@@ -73,8 +174,7 @@ def create_skeleton(opts, namespaces=None):
         E.docGrid(**{w('linePitch'):"360"}),
     ))
 
-    dn = {k:v for k, v in iteritems(namespaces) if k in tuple('wra') + ('wp',)}
-    E = ElementMaker(namespace=dn['w'], nsmap=dn)
+    E = ElementMaker(namespace=namespaces['w'], nsmap={'w':namespaces['w']})
     styles = E.styles(
         E.docDefaults(
             E.rPrDefault(
@@ -95,162 +195,188 @@ def create_skeleton(opts, namespaces=None):
     return doc, styles, body
 
 
+# The dc and cp namespaces are the same in both the transitional and strict
+# variants of the spec, so these tags are valid for any DOCXNamespace
+_DC_TAGS = {n: '{%s}%s' % (TRANSITIONAL_NAMESPACES['dc'], n) for n in ('title', 'creator', 'description', 'language')}
+_CP_TAG_KEYWORDS = '{%s}keywords' % TRANSITIONAL_NAMESPACES['cp']
+_DCTERMS_CREATED = '{%s}created' % TRANSITIONAL_NAMESPACES['dcterms']
+_DCTERMS_MODIFIED = '{%s}modified' % TRANSITIONAL_NAMESPACES['dcterms']
+_XSI_TYPE = '{%s}type' % TRANSITIONAL_NAMESPACES['xsi']
+_NSMAP_CP = {k: TRANSITIONAL_NAMESPACES[k] for k in ('cp', 'dc', 'dcterms', 'xsi')}
+_CP_TAGS = {n: '{%s}%s' % (TRANSITIONAL_NAMESPACES['cp'], n) for n in ('coreProperties', 'revision', 'lastModifiedBy')}
+
+
 def update_doc_props(root, mi, namespace):
-    def setm(name, text=None, ns='dc'):
-        ans = root.makeelement('{%s}%s' % (namespace.namespaces[ns], name))
-        for child in tuple(root):
-            if child.tag == ans.tag:
-                root.remove(child)
-        ans.text = text
-        root.append(ans)
-        return ans
-    setm('title', mi.title)
-    setm('creator', authors_to_string(mi.authors))
+    # namespace is unused, it is kept for API compatibility. Callers may pass
+    # the namespace of a strict document, but the dc and cp namespaces are
+    # the same in strict documents, so the precomputed tags work for both.
+    props = [(_DC_TAGS['title'], mi.title), (_DC_TAGS['creator'], authors_to_string(mi.authors))]
     if mi.tags:
-        setm('keywords', ', '.join(mi.tags), ns='cp')
+        props.append((_CP_TAG_KEYWORDS, ', '.join(mi.tags)))
     if mi.comments:
-        setm('description', mi.comments)
+        props.append((_DC_TAGS['description'], mi.comments))
     if mi.languages:
         l = canonicalize_lang(mi.languages[0])
-        setm('language', lang_as_iso639_1(l) or l)
+        props.append((_DC_TAGS['language'], lang_as_iso639_1(l) or l))
+    # Remove all existing values in a single pass over the children, rather
+    # than one pass per property
+    tags = {tag for tag, text in props}
+    for child in tuple(root):
+        if child.tag in tags:
+            root.remove(child)
+    for tag, text in props:
+        etree.SubElement(root, tag).text = text
+
+
+_DEFAULT_RELATIONSHIPS = (
+    ('STYLES', 'styles.xml'),
+    ('NUMBERING', 'numbering.xml'),
+    ('WEB_SETTINGS', 'webSettings.xml'),
+    ('FONTS', 'fontTable.xml'),
+)
 
 
 class DocumentRelationships(object):
 
     def __init__(self, namespace):
         self.rmap = {}
+        self.next_id = 1
         self.namespace = namespace
-        for typ, target in iteritems({
-                namespace.names['STYLES']: 'styles.xml',
-                namespace.names['NUMBERING']: 'numbering.xml',
-                namespace.names['WEB_SETTINGS']: 'webSettings.xml',
-                namespace.names['FONTS']: 'fontTable.xml',
-        }):
-            self.add_relationship(target, typ)
+        self.image_rtype = namespace.names['IMAGES']
+        self.image_extensions = set()
+        for name, target in _DEFAULT_RELATIONSHIPS:
+            self.add_relationship(target, namespace.names[name])
 
     def get_relationship_id(self, target, rtype, target_mode=None):
         return self.rmap.get((target, rtype, target_mode))
 
     def add_relationship(self, target, rtype, target_mode=None):
-        ans = self.get_relationship_id(target, rtype, target_mode)
+        key = (target, rtype, target_mode)
+        ans = self.rmap.get(key)
         if ans is None:
-            ans = 'rId%d' % (len(self.rmap) + 1)
-            self.rmap[(target, rtype, target_mode)] = ans
+            ans = 'rId' + unicode_type(self.next_id)
+            self.next_id += 1
+            self.rmap[key] = ans
         return ans
 
     def add_image(self, target):
-        return self.add_relationship(target, self.namespace.names['IMAGES'])
+        self.image_extensions.add(target.rpartition(_EXTSEP)[-1])
+        return self.add_relationship(target, self.image_rtype)
 
     def serialize(self):
-        namespaces = self.namespace.namespaces
-        E = ElementMaker(namespace=namespaces['pr'], nsmap={None:namespaces['pr']})
-        relationships = E.Relationships()
+        esc = _xml_escape
+        parts = [_XML_DECLARATION, _RELS_PREFIX % esc(self.namespace.namespaces['pr'])]
+        append = parts.append
         for (target, rtype, target_mode), rid in iteritems(self.rmap):
-            r = E.Relationship(Id=rid, Type=rtype, Target=target)
+            append(_REL_ENTRY % (esc(rid), esc(rtype), esc(target)))
             if target_mode is not None:
-                r.set('TargetMode', target_mode)
-            relationships.append(r)
-        return xml2str(relationships)
+                append(_REL_TARGET_MODE % esc(target_mode))
+            append(b'/>')
+        append(_RELS_SUFFIX)
+        return b''.join(parts)
+
+
+# Small, fixed entries for which deflate costs more than it saves
+_STORED_ENTRIES = frozenset(('[Content_Types].xml', '_rels/.rels', 'docProps/app.xml', 'word/webSettings.xml'))
+
+
+class DeflatedEntry(object):
+
+    ''' A write-only file like object that compresses data as it is written
+    to it, so that a zip entry can be created without first holding all of
+    its uncompressed data in memory. '''
+
+    def __init__(self, name):
+        self.zinfo = zi = ZipInfo(name, date_time=time.localtime(time.time())[:6])
+        zi.compress_type = ZIP_DEFLATED
+        zi.external_attr = 0o600 << 16
+        zi.file_size = zi.CRC = 0
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self.chunks = []
+
+    def write(self, data):
+        zi = self.zinfo
+        zi.CRC = zlib.crc32(data, zi.CRC)
+        zi.file_size += len(data)
+        compressed = self.compressor.compress(data)
+        if compressed:
+            self.chunks.append(compressed)
+        return len(data)
+
+    def finish(self):
+        self.chunks.append(self.compressor.flush())
+        self.data = b''.join(self.chunks)
+        del self.chunks[:]
+        zi = self.zinfo
+        zi.CRC &= 0xffffffff
+        zi.compress_size = len(self.data)
+        return self
+
+    def add_to(self, zf):
+        zf.writestr(self.zinfo, self.data, raw_bytes=True)
+
+
+def deflate_file(name_and_data):
+    name, data = name_and_data
+    ans = DeflatedEntry(name)
+    ans.write(data() if callable(data) else data)
+    return ans.finish()
 
 
 class DOCX(object):
 
     def __init__(self, opts, log):
         self.namespace = DOCXNamespace()
-        namespaces = self.namespace.namespaces
         self.opts, self.log = opts, log
         self.document_relationships = DocumentRelationships(self.namespace)
-        self.font_table = etree.Element('{%s}fonts' % namespaces['w'], nsmap={k:namespaces[k] for k in 'wr'})
-        self.numbering = etree.Element('{%s}numbering' % namespaces['w'], nsmap={k:namespaces[k] for k in 'wr'})
-        E = ElementMaker(namespace=namespaces['pr'], nsmap={None:namespaces['pr']})
-        self.embedded_fonts = E.Relationships()
+        self.font_table = etree.Element(_W_FONTS, nsmap=_NSMAP_WR)
+        self.numbering = etree.Element(_W_NUMBERING, nsmap=_NSMAP_W)
+        self.embedded_fonts = etree.Element(_PR_RELATIONSHIPS, nsmap=_NSMAP_PR)
         self.fonts = {}
-        self.images = {}
+        # List of (name, data_getter) pairs, in the order they are written
+        self.images = []
 
     # Boilerplate {{{
     @property
     def contenttypes(self):
-        E = ElementMaker(namespace=self.namespace.namespaces['ct'], nsmap={None:self.namespace.namespaces['ct']})
-        types = E.Types()
-        for partname, mt in iteritems({
-            "/word/footnotes.xml": "application/vnd.openxmlformats-officedocument.wordprocessingml.footnotes+xml",
-            "/word/document.xml": "application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml",
-            "/word/numbering.xml": "application/vnd.openxmlformats-officedocument.wordprocessingml.numbering+xml",
-            "/word/styles.xml": "application/vnd.openxmlformats-officedocument.wordprocessingml.styles+xml",
-            "/word/endnotes.xml": "application/vnd.openxmlformats-officedocument.wordprocessingml.endnotes+xml",
-            "/word/settings.xml": "application/vnd.openxmlformats-officedocument.wordprocessingml.settings+xml",
-            "/word/theme/theme1.xml": "application/vnd.openxmlformats-officedocument.theme+xml",
-            "/word/fontTable.xml": "application/vnd.openxmlformats-officedocument.wordprocessingml.fontTable+xml",
-            "/word/webSettings.xml": "application/vnd.openxmlformats-officedocument.wordprocessingml.webSettings+xml",
-            "/docProps/core.xml": "application/vnd.openxmlformats-package.core-properties+xml",
-            "/docProps/app.xml": "application/vnd.openxmlformats-officedocument.extended-properties+xml",
-        }):
-            types.append(E.Override(PartName=partname, ContentType=mt))
-        added = {'png', 'gif', 'jpeg', 'jpg', 'svg', 'xml'}
-        for ext in added:
-            types.append(E.Default(Extension=ext, ContentType=guess_type('a.'+ext)[0]))
-        for ext, mt in iteritems({
-            "rels": "application/vnd.openxmlformats-package.relationships+xml",
-            "odttf": "application/vnd.openxmlformats-officedocument.obfuscatedFont",
-        }):
-            added.add(ext)
-            types.append(E.Default(Extension=ext, ContentType=mt))
-        for fname in self.images:
-            ext = fname.rpartition(os.extsep)[-1]
-            if ext not in added:
-                added.add(ext)
-                mt = guess_type('a.' + ext)[0]
-                if mt:
-                    types.append(E.Default(Extension=ext, ContentType=mt))
-        return xml2str(types)
+        ans = [_ct_prefix()]
+        # Every image in the container has a relationship, so only the few
+        # distinct extensions need to be looked at, not every image. They are
+        # sorted so that the output does not depend on set ordering.
+        for ext in sorted(self.document_relationships.image_extensions - _CT_BUILTIN_EXTS):
+            mt = _mt_for_ext(ext)
+            if mt:
+                ans.append(_ct_default(ext, mt))
+        ans.append(_CT_SUFFIX)
+        return b''.join(ans)
 
     @property
     def appproperties(self):
-        E = ElementMaker(namespace=self.namespace.namespaces['ep'], nsmap={None:self.namespace.namespaces['ep']})
-        props = E.Properties(
-            E.Application(__appname__),
-            E.AppVersion('%02d.%04d' % numeric_version[:2]),
-            E.DocSecurity('0'),
-            E.HyperlinksChanged('false'),
-            E.LinksUpToDate('true'),
-            E.ScaleCrop('false'),
-            E.SharedDoc('false'),
-        )
+        ans = _AP_PREFIX
         if self.mi.publisher:
-            props.append(E.Company(self.mi.publisher))
-        return xml2str(props)
+            ans += b'<Company>' + _xml_escape(self.mi.publisher) + b'</Company>'
+        return ans + _AP_SUFFIX
 
     @property
     def containerrels(self):
-        return textwrap.dedent('''\
-        <?xml version='1.0' encoding='utf-8'?>
-        <Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
-            <Relationship Id="rId3" Type="{APPPROPS}" Target="docProps/app.xml"/>
-            <Relationship Id="rId2" Type="{DOCPROPS}" Target="docProps/core.xml"/>
-            <Relationship Id="rId1" Type="{DOCUMENT}" Target="word/document.xml"/>
-        </Relationships>'''.format(**self.namespace.names)).encode('utf-8')
+        return _CONTAINER_RELS
 
     @property
     def websettings(self):
-        E = ElementMaker(namespace=self.namespace.namespaces['w'], nsmap={'w':self.namespace.namespaces['w']})
-        ws = E.webSettings(
-            E.optimizeForBrowser, E.allowPNG, E.doNotSaveAsSingleFile)
-        return xml2str(ws)
+        return _WEB_SETTINGS
 
     # }}}
 
     def convert_metadata(self, mi):
-        namespaces = self.namespace.namespaces
-        E = ElementMaker(namespace=namespaces['cp'], nsmap={x:namespaces[x] for x in 'cp dc dcterms xsi'.split()})
-        cp = E.coreProperties(E.revision("1"), E.lastModifiedBy('calibre'))
-        ts = utcnow().isoformat(native_string_type('T')).rpartition('.')[0] + 'Z'
-        for x in 'created modified'.split():
-            x = cp.makeelement('{%s}%s' % (namespaces['dcterms'], x), **{'{%s}type' % namespaces['xsi']:'dcterms:W3CDTF'})
-            x.text = ts
-            cp.append(x)
+        cp = etree.Element(_CP_TAGS['coreProperties'], nsmap=_NSMAP_CP)
+        etree.SubElement(cp, _CP_TAGS['revision']).text = '1'
+        etree.SubElement(cp, _CP_TAGS['lastModifiedBy']).text = 'calibre'
+        ts = utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        for x in (_DCTERMS_CREATED, _DCTERMS_MODIFIED):
+            etree.SubElement(cp, x, {_XSI_TYPE:'dcterms:W3CDTF'}).text = ts
         self.mi = mi
         update_doc_props(cp, self.mi, self.namespace)
-        return xml2str(cp)
+        return xml2str(cp, skip_cleanup=True)
 
     def create_empty_document(self, mi):
         self.document, self.styles = create_skeleton(self.opts)[:2]
@@ -258,22 +384,65 @@ class DOCX(object):
     def write(self, path_or_stream, mi, create_empty_document=False):
         if create_empty_document:
             self.create_empty_document(mi)
-        with ZipFile(path_or_stream, 'w') as zf:
-            zf.writestr('[Content_Types].xml', self.contenttypes)
-            zf.writestr('_rels/.rels', self.containerrels)
-            zf.writestr('docProps/core.xml', self.convert_metadata(mi))
-            zf.writestr('docProps/app.xml', self.appproperties)
-            zf.writestr('word/webSettings.xml', self.websettings)
-            zf.writestr('word/document.xml', xml2str(self.document))
-            zf.writestr('word/styles.xml', xml2str(self.styles))
-            zf.writestr('word/numbering.xml', xml2str(self.numbering))
-            zf.writestr('word/fontTable.xml', xml2str(self.font_table))
-            zf.writestr('word/_rels/document.xml.rels', self.document_relationships.serialize())
-            zf.writestr('word/_rels/fontTable.xml.rels', xml2str(self.embedded_fonts))
-            for fname, data_getter in iteritems(self.images):
-                zf.writestr(fname, data_getter())
-            for fname, data in iteritems(self.fonts):
-                zf.writestr(fname, data)
+        # The document can contain sub-trees, such as images, built in other
+        # trees with their own nsmap and the font table only uses the r
+        # namespace when fonts are embedded, so they need cleanup. All the
+        # other trees are built from a root with exactly the nsmap they use.
+        if hasattr(etree, 'cleanup_namespaces'):
+            etree.cleanup_namespaces(self.document)
+            etree.cleanup_namespaces(self.font_table)
+        # Trees are serialized directly into their compressed zip entry, so
+        # that their uncompressed bytes are never held in memory
+        entries = [
+            ('[Content_Types].xml', self.contenttypes),
+            ('_rels/.rels', self.containerrels),
+            ('docProps/core.xml', self.convert_metadata(mi)),
+            ('docProps/app.xml', self.appproperties),
+            ('word/webSettings.xml', self.websettings),
+            ('word/document.xml', self.document),
+            ('word/styles.xml', self.styles),
+            ('word/numbering.xml', self.numbering),
+            ('word/fontTable.xml', self.font_table),
+            ('word/_rels/document.xml.rels', self.document_relationships.serialize),
+            ('word/_rels/fontTable.xml.rels', self.embedded_fonts),
+        ]
+        files = self.images + list(iteritems(self.fonts))
+        stream = path_or_stream
+        if isinstance(stream, io.RawIOBase):
+            # Avoid a write() system call for every zip header and entry
+            stream = io.BufferedWriter(stream, buffer_size=1 << 20)
+        try:
+            with ZipFile(stream, 'w') as zf:
+                for name, payload in entries:
+                    if etree.iselement(payload):
+                        w = DeflatedEntry(name)
+                        # Write the declaration ourselves, as lxml spells the
+                        # encoding as UTF-8 when writing to a file
+                        w.write(_XML_DECLARATION)
+                        etree.ElementTree(payload).write(w, encoding='utf-8', xml_declaration=False)
+                        w.finish().add_to(zf)
+                    else:
+                        zf.writestr(name, payload() if callable(payload) else payload,
+                                    compression=ZIP_STORED if name in _STORED_ENTRIES else ZIP_DEFLATED)
+                if files:
+                    self.write_files(zf, files)
+        finally:
+            if stream is not path_or_stream:
+                stream.detach()
+
+    def write_files(self, zf, files):
+        # Loading and compressing images and fonts is done in worker threads,
+        # as zlib releases the GIL. ZipFile is not thread safe, so the
+        # compressed entries are added from this thread. Files are processed
+        # in batches so that only a few of them are in memory at a time.
+        num = min(cpu_count(), len(files))
+        pool = ThreadPool(processes=num)
+        try:
+            for i in range(0, len(files), num):
+                for entry in pool.map(deflate_file, files[i:i+num]):
+                    entry.add_to(zf)
+        finally:
+            pool.terminate()
 
 
 if __name__ == '__main__':
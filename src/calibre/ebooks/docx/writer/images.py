@@ -174,9 +174,9 @@ class ImagesManager(object):
         fname += os.extsep + fmt.lower()
         return fname
 
-    def serialize(self, images_map):
+    def serialize(self, images):
         for img in itervalues(self.images):
-            images_map['word/' + img.fname] = partial(self.get_data, img.item)
+            images.append(('word/' + img.fname, partial(self.get_data, img.item)))
 
     def get_data(self, item):
         try: